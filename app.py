@@ -1,12 +1,15 @@
 import json
-import pandas as pd
 import streamlit as st
 import hashlib
 import random
+from collections import Counter
 from datetime import datetime
+from functools import lru_cache
 from pathlib import Path
 import re
+import time
 import gspread
+from gspread.utils import rowcol_to_a1
 from oauth2client.service_account import ServiceAccountCredentials
 from typing import Any, Dict, List, Optional, Tuple
 
@@ -18,6 +21,11 @@ except ModuleNotFoundError:
     except ModuleNotFoundError:
         tomllib = None
 
+try:
+    import orjson  # 高速な JSON パーサ（未インストールなら標準 json を使う）
+except ModuleNotFoundError:
+    orjson = None
+
 # ===== パスと定数 =====
 RESULTS_PATH = Path("results/abtest_results.jsonl")
 BASELINE_PATH = Path("data/worse2.json")
@@ -43,15 +51,36 @@ CSV_COLUMNS = [
     "comment",
 ]
 
+# プロフィール（パーソナリティ質問）として保存・復元するカラム
+PROFILE_COLUMNS = ("kyushu_student", "info_course_taken", "info_course_grade")
+
+# パーソナリティ質問のウィジェットキー（ユーザー切り替え時にリセットする）
+PROFILE_WIDGET_KEYS = ("kyushu_student", "info_course_taken", "info_grade_text")
+
+# パーソナリティ質問の選択肢（先頭は未選択を表すプレースホルダー）
+KYUSHU_OPTIONS = ("-- 選択してください --", "はい", "いいえ")
+INFO_COURSE_OPTIONS = ("-- 選択してください --", "はい", "いいえ")
+GRADE_OPTIONS = ("未回答", "A", "B", "C", "D", "F")
+
+# 回答済み判定とプロフィール復元のためにシートから読む列（先頭2つは固定）
+# 回答済みかどうかは item_index ではなく source_userid で判定する（提示順が変わっても崩れないように）
+SHEET_READ_COLUMNS = ("user_id", "source_userid") + PROFILE_COLUMNS
+
+# セッション内で user_id ごとの (回答済み source_userid, プロフィール) を保持する session_state のキー
+ANSWERED_CACHE_KEY = "answered_cache"
+
+# Sheets API がクォータ超過（429）を返したときの再試行回数（待ち時間は 1, 2, 4, 8 秒 + 揺らぎ）
+SHEETS_MAX_RETRIES = 5
+
 # ABテスト対象とする userid のサンプル一覧（順序は後でシャッフルされる）
 correct_uid = [
-    "C-2022-1_U57"
-    "C-2022-1_U73"
-    "C-2021-1_U8"
-    "C-2021-2_U35"
-    "C-2021-2_U161"
-    "C-2021-2_U23"
-    "C-2021-1_U29"
+    "C-2022-1_U57",
+    "C-2022-1_U73",
+    "C-2021-1_U8",
+    "C-2021-2_U35",
+    "C-2021-2_U161",
+    "C-2021-2_U23",
+    "C-2021-1_U29",
     "C-2021-1_U66",
     "C-2021-1_U21",
     "C-2021-2_U172",
@@ -71,6 +100,9 @@ incorrect_uid = [
 ]
 
 use_uid = correct_uid + incorrect_uid
+# use_uid の優先順位（重複は最初の位置を採用）と所属判定用の集合
+USE_UID_RANK = {uid: rank for rank, uid in enumerate(dict.fromkeys(use_uid))}
+USE_UID_SET = frozenset(USE_UID_RANK)
 
 # correct_uid をすべて出題するのが基本。部分出題したい場合は max_items を明示的に指定する。
 MAX_ITEMS = len(use_uid)
@@ -81,6 +113,39 @@ RATING_SCALE = [
     "B がやや良い",
     "B が強く良い",
 ]
+# スライダーは位置 (0=左端「A が強く良い」〜4=右端「B が強く良い」) を int で保持する。
+# RATING_SCALE は左右 (A/B) 基準の表記なので、保存値は左右配置によらず RATING_SCALE[位置]。
+RATING_POSITIONS = tuple(range(len(RATING_SCALE)))
+RATING_CENTER = len(RATING_SCALE) // 2
+
+# 画面レイアウトの列幅（本文:評価欄、評価スライダー行の「Aが良い」:スライダー:「Bが良い」）
+LAYOUT_COL_WIDTHS = (3.5, 1.5)
+RATING_COL_WIDTHS = (1.5, 4.0, 1.5)
+
+# 評価項目: (保存カラム名, 見出し, 説明)
+QUESTIONS: Tuple[Tuple[str, str, str], ...] = (
+    ("readability", "ステップ1：可読性", "どちらが読みやすいと感じますか？"),
+    (
+        "persuasiveness",
+        "ステップ2：説得力",
+        "どちらの根拠が明確だと思いますか？",
+    ),
+    (
+        "actionability",
+        "ステップ3：行動可能性",
+        "成績向上のためのフィードバックが明確に示されていますか？",
+    ),
+    (
+        "hallucination",
+        "ステップ4：ハルシネーション",
+        "嘘や誇張と思われる表現を使っていますか？",
+    ),
+    (
+        "usefulness",
+        "ステップ5：有用性",
+        "あなたが学生だった場合、どちらのフィードバックが役に立つと思いますか？",
+    ),
+)
 
 
 # ===== スプレッドシート接続機能 =====
@@ -147,48 +212,120 @@ def get_worksheet():
         st.stop()
 
 
-def init_sheet_header(worksheet):
-    """シートが空の場合、ヘッダー行を追加する"""
+def call_with_backoff(fn, *args, **kwargs):
+    """Sheets API 呼び出しを実行し、429（クォータ超過）のときだけ指数バックオフで再試行する"""
+    for attempt in range(SHEETS_MAX_RETRIES):
+        try:
+            return fn(*args, **kwargs)
+        except gspread.exceptions.APIError as e:
+            status = getattr(getattr(e, "response", None), "status_code", None)
+            if status != 429 or attempt == SHEETS_MAX_RETRIES - 1:
+                raise
+            time.sleep(2**attempt + random.random())
+
+
+@st.cache_resource(show_spinner=False)
+def _ensure_sheet_header() -> bool:
+    """シートが空の場合、ヘッダー行を追加する（プロセス内で一度だけ確認する）。
+    1行目だけを row_values で読むので、シート全体は取得しない。
+    失敗時は例外を投げ、結果をキャッシュしない（次回に再確認される）。
+    """
+    worksheet = get_worksheet()
+    if not call_with_backoff(worksheet.row_values, 1):
+        call_with_backoff(worksheet.append_row, CSV_COLUMNS)
+    return True
+
+
+@st.cache_resource(show_spinner=False)
+def _sheet_read_ranges() -> Tuple[str, ...]:
+    """SHEET_READ_COLUMNS の各列の A1 範囲（ヘッダー行を除く 2 行目以降）を返す。
+    列位置はシートの実際の1行目から列名で決める（user_id は userid も可）。
+    空のシートには CSV_COLUMNS がヘッダーとして書かれるので、その並びを使う。
+    見つからない列があれば例外を投げる（誤った列を黙って読まないように）。
+    プロセス内で一度だけ確認し、失敗時は結果をキャッシュしない。
+    """
+    header = call_with_backoff(get_worksheet().row_values, 1) or CSV_COLUMNS
+    ranges: List[str] = []
+    for col in SHEET_READ_COLUMNS:
+        # カラム名の揺らぎを吸収（user_id か userid か）
+        names = (col, "userid") if col == "user_id" else (col,)
+        pos = next((header.index(n) for n in names if n in header), None)
+        if pos is None:
+            raise RuntimeError(
+                f"スプレッドシートのヘッダーに {col} 列が見つかりません: {header}"
+            )
+        letter = rowcol_to_a1(1, pos + 1)[:-1]
+        ranges.append(f"{letter}2:{letter}")
+    return tuple(ranges)
+
+
+def init_sheet_header() -> None:
+    """ヘッダー行の確認。接続エラーなどはここでは無視する"""
     try:
-        existing = worksheet.get_all_values()
-        if not existing:
-            worksheet.append_row(CSV_COLUMNS)
+        _ensure_sheet_header()
     except Exception:
         pass
 
 
-# ===== データロード（変更なし） =====
-def load_json_dict(path: Path) -> Dict[str, Any]:
+# ===== データロード =====
+@st.cache_data(show_spinner=False)
+def _parse_json_file(path_str: str, mtime: float) -> Dict[str, Any]:
+    """JSON ファイルをパースする（mtime をキーに含め、更新時のみ再パース）"""
+    path = Path(path_str)
+    if orjson is not None:
+        return orjson.loads(path.read_bytes())
+    with path.open(encoding="utf-8") as f:
+        return json.load(f)
+
+
+def _file_mtime(path: Path) -> float:
+    """ファイルの更新時刻を返す（無ければエラー表示して停止）"""
     if not path.exists():
         st.error(f"データファイルが見つかりません: {path}")
         st.stop()
-    with path.open(encoding="utf-8") as f:
-        return json.load(f)
+    return path.stat().st_mtime
+
+
+def load_json_dict(path: Path) -> Dict[str, Any]:
+    return _parse_json_file(str(path), _file_mtime(path))
+
 
+def data_file_mtimes() -> Tuple[float, float]:
+    """(baseline, advice) の更新時刻。下流のキャッシュのキーに渡し、ファイル更新時に作り直させる"""
+    return _file_mtime(BASELINE_PATH), _file_mtime(ADVICE_PATH)
 
+
+# clean_baseline_text で使う正規表現と見出しラベル（呼び出しごとに組み立てない）
+# 先頭の "assistant" ラベルと、その直後の「以下は…フィードバック」などの前置き行を1回で除去する
+_PREFIX_RE = re.compile(
+    r"\A(?:(?i:assistant)\b\s*)?"
+    r"(?:以下は[^\n]*?(?:生成文|フィードバック|改善アドバイス)[^\n]*\n+)?"
+)
+_HEADING_RE = re.compile(r"^(\s*)(#+)\s*(.*)$")
+_LABEL_HEADINGS = frozenset(
+    (
+        "あなたの強み",
+        "改善が必要なポイント",
+        "これから意識したいこと",
+        "まとめ",
+    )
+)
+
+
+# 同じ本文は出題レコードの組み立てとデバッグ表示の両方で整形されるので、結果を覚えておく
+@lru_cache(maxsize=128)
 def clean_baseline_text(text: str) -> str:
     if not text:
         return ""
     cleaned = text.strip()
     # 先頭の "assistant" ラベルやボイラープレートを除去
-    cleaned = re.sub(r"(?i)\Aassistant\b\s*\n*", "", cleaned).strip()
-    cleaned = re.sub(
-        r"\A以下は[^\n]*?(生成文|フィードバック|改善アドバイス)[^\n]*\n+",
-        "",
-        cleaned,
-    ).strip()
+    cleaned = _PREFIX_RE.sub("", cleaned, count=1).strip()
     cleaned = cleaned.replace(" �善", "改善")
     # 見出しレベルを統一（最初の # は ###、2つ目以降は ####）
     heading_count = 0
     normalized_lines: List[str] = []
-    label_headings = [
-        "あなたの強み",
-        "改善が必要なポイント",
-        "これから意識したいこと",
-        "まとめ",
-    ]
     for line in cleaned.splitlines():
-        m = re.match(r"^(\s*)(#+)\s*(.*)$", line)
+        m = _HEADING_RE.match(line)
         if m:
             leading_ws, _hashes, rest = m.groups()
             rest_stripped = rest.strip()
@@ -202,178 +339,158 @@ def clean_baseline_text(text: str) -> str:
             if stripped.startswith("**") and stripped.endswith("】"):
                 stripped = stripped[2:-1].strip()
                 line = stripped
-            matched = next((h for h in label_headings if stripped == h), None)
-            if matched:
-                line = line.replace(matched, f"{matched}：", 1)
+            # ラベルとの完全一致だけを見るので、集合の所属判定1回で済む
+            if stripped in _LABEL_HEADINGS:
+                line = line.replace(stripped, f"{stripped}：", 1)
             normalized_lines.append(line)
     cleaned = "\n".join(normalized_lines).strip()
     return cleaned
 
 
 # ===== 結果の読み書き（スプレッドシート版に変更） =====
-# app.py の load_answered_indices 関数をこれに置き換える
-
-
-def load_answered_indices(user_id: str) -> set[int]:
-    """スプレッドシートから回答済みの item_index を取得する（型変換対応版）"""
-    worksheet = get_worksheet()
-
-    try:
-        # 全データを取得
-        records = worksheet.get_all_records()
-        if not records:
-            return set()
-
-        df = pd.DataFrame(records)
-
-        # カラム名の揺らぎを吸収（user_id か userid か）
-        user_col = None
-        if "user_id" in df.columns:
-            user_col = "user_id"
-        elif "userid" in df.columns:
-            user_col = "userid"
-
-        if user_col is None:
-            return set()
-
-        # 【重要】データフレーム側と入力側の両方を「文字列」に強制変換して比較する
-        # これにより 123(int) と "123"(str) の不一致を防ぐ
-        df[user_col] = df[user_col].astype(str).str.strip()
-        target_user_id = str(user_id).strip()
-
-        user_df = df[df[user_col] == target_user_id]
-
-        # item_index が存在するか確認
-        idx_col = None
-        if "item_index" in user_df.columns:
-            idx_col = "item_index"
-        elif "item_index" in df.columns:  # 全体から探す
-            idx_col = "item_index"
-
-        if idx_col:
-            # 空文字や欠損を除外して int に変換
-            return set(
-                pd.to_numeric(user_df[idx_col], errors="coerce")
-                .dropna()
-                .astype(int)
-                .tolist()
-            )
-
-        return set()
-
-    except Exception as e:
-        # デバッグ用にエラーを表示したければコメントアウトを外す
-        # st.error(f"読み込みエラー: {e}")
-        return set()
+@st.cache_data(ttl=60, show_spinner=False)
+def _fetch_sheet_rows() -> List[Tuple[str, ...]]:
+    """シートの全行から (user_id, source_userid, *PROFILE_COLUMNS) だけを取り出して返す。
+    全セッションで共有し、60秒ごと（または追記直後）にだけシートを読み直す。
+    必要な列だけを batch_get で列方向に取得し、全17列・行ごとの dict は作らない。
+    """
+    columns = call_with_backoff(
+        get_worksheet().batch_get,
+        list(_sheet_read_ranges()),
+        major_dimension="COLUMNS",
+        value_render_option="UNFORMATTED_VALUE",
+    )
+    # 各範囲は [[値, 値, ...]]（空列なら []）。末尾の空セルは省略されるので長さを揃える
+    cells = [col[0] if col else [] for col in columns]
+    n_rows = max((len(c) for c in cells), default=0)
+    return [
+        tuple(str(c[i]) if i < len(c) else "" for c in cells) for i in range(n_rows)
+    ]
 
 
 def save_response(record: Dict[str, Any]) -> None:
-    """回答1件をスプレッドシートに追記する"""
+    """回答1件をスプレッドシートに追記する（失敗時は例外をそのまま投げる）"""
+    # 定義したカラム順序に従って値をリスト化する
+    row_values = [record.get(col, "") for col in CSV_COLUMNS]
+
     worksheet = get_worksheet()
+    # 初回の書き込み時だけヘッダーを確認する（2回目以降はキャッシュ済みで通信しない）
+    init_sheet_header()
+    # 送信ごとにすぐ書き込む（タブを閉じても回答が失われないように）。
+    # append_rows は values.append を1回呼ぶだけ。INSERT_ROWS で表の末尾に新しい行として挿入する
+    call_with_backoff(
+        worksheet.append_rows,
+        [row_values],
+        value_input_option="RAW",
+        insert_data_option="INSERT_ROWS",
+    )
+    # 追記した行が次の読み込みに反映されるよう、共有キャッシュを破棄する
+    _fetch_sheet_rows.clear()
 
-    # 初回だけヘッダーチェック
-    init_sheet_header(worksheet)
+    # セッション内の回答済みキャッシュにも反映し、次の rerun でシートを読み直さない
+    cache = st.session_state.get(ANSWERED_CACHE_KEY, {})
+    uid = str(record.get("user_id", "")).strip()
+    if uid in cache:
+        answered, _ = cache[uid]
+        answered.add(str(record["source_userid"]).strip())
+        cache[uid] = (answered, {col: record.get(col) for col in PROFILE_COLUMNS})
 
-    # 定義したカラム順序に従って値をリスト化する
-    row_values = []
-    for col in CSV_COLUMNS:
-        row_values.append(record.get(col, ""))
 
-    # 追記
-    worksheet.append_row(row_values)
+def extract_baseline_response(entry: Dict[str, Any], uid: str) -> str:
+    """baseline の entry から本文を取り出す（response → text → uid キー → 最初の文字列の順）"""
+    if not isinstance(entry, dict):
+        return ""
+    if isinstance(entry.get("response"), str) and entry["response"]:
+        return entry["response"]
+    if isinstance(entry.get("text"), str) and entry["text"]:
+        return entry["text"]
+    if isinstance(entry.get(uid), str) and entry[uid]:
+        return entry[uid]
+    # worse2.json のように「grade 以外の1キーが本文」の形を想定
+    for key, val in entry.items():
+        if key in ("grade", "userid", "user_id"):
+            continue
+        if isinstance(val, str) and val:
+            return val
+    return ""
+
+
+def build_user_map(d: Dict[str, Any]) -> Dict[str, Dict[str, Any]]:
+    """userid -> entry の map を作る。
+    候補はトップレベルキーと entry 内の userid / user_id で、先に見つかったものを優先する。
+    """
+    m: Dict[str, Dict[str, Any]] = {}
+    for top_key, entry in d.items():
+        m.setdefault(top_key, entry)
+        if isinstance(entry, dict):
+            for fld in ("userid", "user_id"):
+                val = entry.get(fld)
+                if isinstance(val, str) and val:
+                    m.setdefault(val, entry)
+    return m
+
+
+@st.cache_resource(show_spinner=False)
+def get_data_files(
+    baseline_mtime: float, advice_mtime: float
+) -> Tuple[Dict[str, Any], Dict[str, Any]]:
+    """(baseline, advice) のパース結果を返す。出題レコードの組み立てとデバッグ表示で共有する。
+    引数の mtime はキャッシュのキー（data_file_mtimes() を渡す）で、ファイル更新時に読み直す。
+    戻り値は読み取り専用として扱うこと。
+    """
+    return load_json_dict(BASELINE_PATH), load_json_dict(ADVICE_PATH)
 
 
-def get_next_index(all_indices: List[int], answered: set[int]) -> int | None:
-    for idx in all_indices:
-        if idx not in answered:
-            return idx
-    return None
+@st.cache_resource(show_spinner=False)
+def get_user_maps(
+    baseline_mtime: float, advice_mtime: float
+) -> Tuple[Dict[str, Dict[str, Any]], Dict[str, Dict[str, Any]]]:
+    """(baseline の userid map, advice の userid map) を返す。
+    トップレベルキーが一致しない場合とデバッグ表示でだけ必要なので、呼ばれたときに初めて作る。
+    """
+    baseline, advice = get_data_files(baseline_mtime, advice_mtime)
+    return build_user_map(baseline), build_user_map(advice)
 
 
-# ...existing code...
-def load_items(
-    max_items: int = MAX_ITEMS, *, user_id: str | None = None
-) -> pd.DataFrame:
-    """baseline応答とstudent adviceをペアにしたDataFrameを返す。
+@st.cache_resource(show_spinner=False)
+def _build_base_records(
+    max_items: int, baseline_mtime: float, advice_mtime: float
+) -> List[Dict[str, Any]]:
+    """ユーザーに依存しない出題レコード（シャッフル前・item_index なし）を返す。
     - 基本は correct_uid に含まれる userid のみを対象とし、なければ共通集合を使う
-    - user_id を指定した場合は、その文字列に基づく決定的な乱数シードで出題順をシャッフルする
+    - JSON の読み込みと本文の整形はファイルの版（mtime）ごとに一度だけ行い、全セッションで共有する
+    - cache_resource なので呼び出しごとのコピーは作られない。戻り値は読み取り専用として扱うこと
     """
-    baseline = load_json_dict(BASELINE_PATH)
-    advice = load_json_dict(ADVICE_PATH)
-
-    # ユーザID候補を収集して map: userid -> entry を作成
-    def build_user_map(d: Dict[str, Any]) -> Dict[str, Dict[str, Any]]:
-        m: Dict[str, Dict[str, Any]] = {}
-        for top_key, entry in d.items():
-            # 候補: トップレベルキー、entry 内の userid / user_id
-            candidates = [top_key]
-            if isinstance(entry, dict):
-                for fld in ("userid", "user_id"):
-                    val = entry.get(fld)
-                    if isinstance(val, str) and val:
-                        candidates.append(val)
-            # 先に見つかったものを優先して登録（重複 userid があれば最初のもの）
-            for uid in candidates:
-                if uid not in m:
-                    m[uid] = entry
-        return m
-
-    def extract_baseline_response(entry: Dict[str, Any], uid: str) -> str:
-        if not isinstance(entry, dict):
-            return ""
-        if isinstance(entry.get("response"), str) and entry["response"]:
-            return entry["response"]
-        if isinstance(entry.get("text"), str) and entry["text"]:
-            return entry["text"]
-        if isinstance(entry.get(uid), str) and entry[uid]:
-            return entry[uid]
-        # worse2.json のように「grade 以外の1キーが本文」の形を想定
-        for key, val in entry.items():
-            if key in ("grade", "userid", "user_id"):
-                continue
-            if isinstance(val, str) and val:
-                return val
-        return ""
-
-    base_map = build_user_map(baseline)
-    advice_map = build_user_map(advice)
+    baseline, advice = get_data_files(baseline_mtime, advice_mtime)
 
     # 共通の userid を取得（まずトップレベル同一キー集合を優先）
     top_keys_common = sorted(set(baseline.keys()) & set(advice.keys()))
     if top_keys_common:
+        # トップレベルで一致するなら map を作らずに元の dict を直接引く
         common_userids = top_keys_common
+        base_map, advice_map = baseline, advice
     else:
         # トップレベル一致がなければ entry 内 userid でマッチさせる
+        base_map, advice_map = get_user_maps(baseline_mtime, advice_mtime)
         common_userids = sorted(set(base_map.keys()) & set(advice_map.keys()))
 
-    # use_uid にあるものを優先し、重複を排除
-    prioritized_uids: List[str] = []
-    if use_uid:
-        for uid in use_uid:
-            if uid in common_userids and uid not in prioritized_uids:
-                prioritized_uids.append(uid)
+    # use_uid にあるものを use_uid の順で優先する（USE_UID_RANK で重複排除済み）
+    prioritized_uids = sorted(
+        USE_UID_SET.intersection(common_userids), key=USE_UID_RANK.__getitem__
+    )
     # use_uid で何も拾えなかった場合は共通集合を丸ごと使う
     if not prioritized_uids:
         prioritized_uids = list(common_userids)
 
     if not prioritized_uids:
-        return pd.DataFrame()
-
-    items_order = prioritized_uids[:max_items]
-    if user_id:
-        seed = int.from_bytes(
-            hashlib.sha256(f"order_{user_id}".encode("utf-8")).digest()[:8], "big"
-        )
-        rng = random.Random(seed)
-        rng.shuffle(items_order)
+        return []
 
     records: List[Dict[str, Any]] = []
-    for idx, uid in enumerate(items_order):
+    for uid in prioritized_uids[:max_items]:
         base_entry = base_map.get(uid, {})
         advice_entry = advice_map.get(uid, {})
         records.append(
             {
-                "item_index": idx,
                 "source_userid": base_entry.get(
                     "userid", base_entry.get("user_id", uid)
                 ),
@@ -381,16 +498,52 @@ def load_items(
                 "baseline_response": clean_baseline_text(
                     extract_baseline_response(base_entry, uid)
                 ),
-                "student_advice_title": advice_entry.get("student_advice_title", "")
-                or advice_entry.get("title", ""),
-                "student_advice_body": advice_entry.get("student_advice_body", "")
-                or advice_entry.get("body", ""),
+                "student_advice_title": advice_entry.get("student_advice_title")
+                or advice_entry.get("title")
+                or "",
+                "student_advice_body": advice_entry.get("student_advice_body")
+                or advice_entry.get("body")
+                or "",
                 "student_grade": advice_entry.get("grade", ""),
             }
         )
 
-    df = pd.DataFrame(records).sort_values("item_index").reset_index(drop=True)
-    return df
+    return records
+
+
+def _user_order(user_id: str, n: int) -> List[int]:
+    """user_id から決まる出題順（0..n-1 の並べ替え）を返す。
+    途中再開で順序が変わらないよう、従来どおり SHA-256 シード + random.Random を使う。
+    呼び出しはセッションごとに1回（結果は main が items_records として保持する）なのでキャッシュしない。
+    """
+    seed = int.from_bytes(
+        hashlib.sha256(f"order_{user_id}".encode("utf-8")).digest()[:8], "big"
+    )
+    order = list(range(n))
+    random.Random(seed).shuffle(order)
+    return order
+
+
+def count_items(max_items: int = MAX_ITEMS) -> int:
+    """出題件数だけを返す（説明ページなど、レコード本体が不要な箇所用）"""
+    return len(_build_base_records(max_items, *data_file_mtimes()))
+
+
+def load_items(
+    max_items: int = MAX_ITEMS, *, user_id: str | None = None
+) -> List[Dict[str, Any]]:
+    """baseline応答とstudent adviceをペアにしたレコードのリストを返す（item_index 順）。
+    - 共通部分はキャッシュ済みの _build_base_records を使い、ここでは並べ替えだけを行う
+    - user_id を指定した場合は、その文字列に基づく決定的な乱数シードで出題順をシャッフルする
+    """
+    base_records = _build_base_records(max_items, *data_file_mtimes())
+    if user_id:
+        order = _user_order(user_id, len(base_records))
+    else:
+        order = range(len(base_records))
+
+    # 並べ替えた順に item_index を採番する（records は item_index 順になる）
+    return [{"item_index": idx, **base_records[i]} for idx, i in enumerate(order)]
 
 
 def debug_admin_view(user_id: str) -> bool:
@@ -398,25 +551,9 @@ def debug_admin_view(user_id: str) -> bool:
         return False
 
     st.title("Debug: baseline data viewer")
-    baseline = load_json_dict(BASELINE_PATH)
-    advice = load_json_dict(ADVICE_PATH)
-
-    def build_user_map(d: Dict[str, Any]) -> Dict[str, Dict[str, Any]]:
-        m: Dict[str, Dict[str, Any]] = {}
-        for top_key, entry in d.items():
-            candidates = [top_key]
-            if isinstance(entry, dict):
-                for fld in ("userid", "user_id"):
-                    val = entry.get(fld)
-                    if isinstance(val, str) and val:
-                        candidates.append(val)
-            for uid in candidates:
-                if uid not in m:
-                    m[uid] = entry
-        return m
-
-    base_map = build_user_map(baseline)
-    advice_map = build_user_map(advice)
+    mtimes = data_file_mtimes()
+    baseline, advice = get_data_files(*mtimes)
+    base_map, advice_map = get_user_maps(*mtimes)
     top_keys_common = set(baseline.keys()) & set(advice.keys())
     map_common = set(base_map.keys()) & set(advice_map.keys())
     st.caption(
@@ -424,45 +561,32 @@ def debug_admin_view(user_id: str) -> bool:
         f"match(top keys): {len(top_keys_common)} | match(mapped): {len(map_common)}"
     )
 
-    grade_series = (
-        pd.DataFrame(
-            {"grade": [entry.get("grade", "") for entry in base_map.values()]}
-        )
-        .fillna("")
-        .assign(grade=lambda df: df["grade"].astype(str).str.strip())
-    )
-    if not grade_series.empty:
-        grade_counts = grade_series["grade"].value_counts(dropna=False)
-        grade_percent = (grade_counts / len(grade_series) * 100).round(1)
-        grade_table = (
-            pd.DataFrame({"count": grade_counts, "percent": grade_percent})
-            .reset_index()
-            .rename(columns={"index": "grade"})
-        )
+    grades = [str(entry.get("grade") or "").strip() for entry in base_map.values()]
+    if grades:
+        grade_table = [
+            {
+                "grade": grade,
+                "count": count,
+                "percent": round(count / len(grades) * 100, 1),
+            }
+            for grade, count in Counter(grades).most_common()
+        ]
         st.dataframe(grade_table, use_container_width=True)
 
-    rows: List[Dict[str, Any]] = []
-    for uid, entry in baseline.items():
-        text = ""
-        grade = ""
-        if isinstance(entry, dict):
-            grade = entry.get("grade", "")
-            if isinstance(entry.get("response"), str) and entry["response"]:
-                text = entry["response"]
-            elif isinstance(entry.get("text"), str) and entry["text"]:
-                text = entry["text"]
-            elif isinstance(entry.get(uid), str) and entry[uid]:
-                text = entry[uid]
-            else:
-                for key, val in entry.items():
-                    if key in ("grade", "userid", "user_id"):
-                        continue
-                    if isinstance(val, str) and val:
-                        text = val
-                        break
-        else:
-            text = str(entry)
-        rows.append({"userid": uid, "grade": grade, "text": text})
+    # 本文の取り出しは出題レコードと同じ extract_baseline_response を使う
+    # （dict でない entry はそのまま文字列化して表示する）
+    rows: List[Dict[str, Any]] = [
+        (
+            {
+                "userid": uid,
+                "grade": entry.get("grade", ""),
+                "text": extract_baseline_response(entry, uid),
+            }
+            if isinstance(entry, dict)
+            else {"userid": uid, "grade": "", "text": str(entry)}
+        )
+        for uid, entry in baseline.items()
+    ]
 
     if "debug_index" not in st.session_state:
         st.session_state.debug_index = 0
@@ -484,7 +608,7 @@ def debug_admin_view(user_id: str) -> bool:
         st.markdown(clean_baseline_text(current["text"]))
         st.divider()
 
-    st.dataframe(pd.DataFrame(rows), use_container_width=True)
+    st.dataframe(rows, use_container_width=True)
     with st.expander("baseline plain text (no markdown)"):
         for row in rows:
             st.text(f"[{row['userid']}] (grade: {row['grade']})")
@@ -498,51 +622,48 @@ def debug_admin_view(user_id: str) -> bool:
 
 
 # ===== ユーザーデータ管理（進捗読み込み＆プロフィール復元） =====
-def load_user_data(user_id: str) -> Tuple[set[int], Optional[Dict[str, str]]]:
+def load_user_data(user_id: str) -> Tuple[set[str], Optional[Dict[str, str]]]:
     """
     指定されたuser_idに関連するデータをスプレッドシートから全検索する。
-    戻り値: (回答済みindexの集合, 最後に保存されたプロフィール情報の辞書)
+    一度読み込んだ結果はセッション内にキャッシュし、以降の rerun ではシートを読まない。
+    戻り値: (回答済みsource_useridの集合, 最後に保存されたプロフィール情報の辞書)
     """
-    worksheet = get_worksheet()
+    target_uid_str = str(user_id).strip()
+    cache = st.session_state.setdefault(ANSWERED_CACHE_KEY, {})
+    if target_uid_str in cache:
+        answered_sources, last_profile = cache[target_uid_str]
+        return set(answered_sources), last_profile
+
+    # 読み込みに失敗したまま「回答なし」として進めると、回答済みの項目を再出題して
+    # 行が重複するため、どの失敗でもエラーを表示してここで止める
     try:
-        records = worksheet.get_all_records()
-        if not records:
-            return set(), None
-
-        target_uid_str = str(user_id).strip()
-        answered_indices = set()
-        last_profile = None
+        rows = _fetch_sheet_rows()
+    except Exception as e:
+        print(f"Error loading user data: {e}")
+        st.error(
+            f"回答状況の読み込みに失敗しました。しばらくしてからページを再読み込みしてください。({e})"
+        )
+        st.stop()
 
-        # シンプルに全行ループして、user_idが一致するものを探す
-        for row in records:
-            # カラム名の揺らぎ対応
-            row_uid = row.get("user_id") or row.get("userid") or ""
+    answered_sources = set()
+    last_profile = None
 
-            # 文字列化して空白除去して比較（これが最も確実）
-            if str(row_uid).strip() == target_uid_str:
+    # シンプルに全行ループして、user_idが一致するものを探す
+    for row_uid, source_uid, *profile in rows:
+        # 文字列化して空白除去して比較（これが最も確実）
+        if str(row_uid).strip() == target_uid_str:
 
-                # 回答済みインデックスを回収
-                idx_val = row.get("item_index")
-                if idx_val is not None and str(idx_val).strip() != "":
-                    try:
-                        answered_indices.add(int(idx_val))
-                    except ValueError:
-                        pass
-
-                # プロフィール情報を保持（上書きしていくので最後に見つかったものが最新になる）
-                # 値が空でない場合のみ取得するようにする
-                if row.get("kyushu_student"):
-                    last_profile = {
-                        "kyushu_student": row.get("kyushu_student"),
-                        "info_course_taken": row.get("info_course_taken"),
-                        "info_course_grade": row.get("info_course_grade"),
-                    }
+            # 回答済みの source_userid を回収（item_index は提示順に依存するので使わない）
+            if str(source_uid).strip() != "":
+                answered_sources.add(str(source_uid).strip())
 
-        return answered_indices, last_profile
+            # プロフィール情報を保持（上書きしていくので最後に見つかったものが最新になる）
+            # 値が空でない場合のみ取得するようにする（profile[0] は kyushu_student）
+            if profile[0]:
+                last_profile = dict(zip(PROFILE_COLUMNS, profile))
 
-    except Exception as e:
-        print(f"Error loading user data: {e}")
-        return set(), None
+    cache[target_uid_str] = (answered_sources, last_profile)
+    return set(answered_sources), last_profile
 
 
 # ===== Streamlit アプリ本体 =====
@@ -551,12 +672,8 @@ def main():
         page_title="Feedback A/B Test", layout="wide", initial_sidebar_state="collapsed"
     )
 
-    # 最初にスプレッドシート接続テスト＆ヘッダー初期化
-    ws = get_worksheet()
-    init_sheet_header(ws)
-
-    df_preview = load_items()
-    if df_preview.empty:
+    n_items = count_items()
+    if not n_items:
         st.error(
             "比較対象となるデータが見つかりません。dataフォルダのJSONを確認してください。"
         )
@@ -570,11 +687,11 @@ def main():
             f"""
 このアプリでは、大学の講義「情報科学」を受講した学生に対するフィードバックを比較評価していただきます。
 
-- 評価するフィードバックは {len(df_preview)} 件あります。
+- 評価するフィードバックは {n_items} 件あります。
 - 所要時間は15~20分程度を想定しています。
 - 回答前に簡単なパーソナリティ設問へ回答してもらいます。
 - 各サンプルについて5項目（可読性/説得力/行動可能性/ハルシネーション/有用性）で、A・Bいずれが優れているか，5段階で選択いただきます。
-- {len(df_preview)} 件すべて回答すると終了です。同じ名前でアクセスすれば途中から再開できます。
+- {n_items} 件すべて回答すると終了です。同じ名前でアクセスすれば途中から再開できます。
 回答よろしくお願いいたします！
 
 """
@@ -613,15 +730,22 @@ def main():
 
     # ユーザー切り替え時のセッション初期化
     if st.session_state.get("current_user_id") != user_id:
-        st.session_state.current_user_id = user_id
-        st.session_state.current_index = None
-        st.session_state.survey_answers = None
-
         # ウィジェットのキーを削除してリセットさせる
-        for widget_key in ("kyushu_student", "info_course_taken", "info_grade_text"):
+        # （前のユーザーの評価・コメント欄は描画されなくなった時点で Streamlit が破棄する）
+        for widget_key in PROFILE_WIDGET_KEYS:
             if widget_key in st.session_state:
                 del st.session_state[widget_key]
 
+        st.session_state.current_user_id = user_id
+        st.session_state.pending_indices = None
+        st.session_state.survey_answers = None
+        st.session_state.items_records = None
+        st.session_state._render_cache = {}
+        # ウィジェットのキーに使う ID。hash() はプロセスごとに変わるため digest を使う
+        st.session_state.participant_key = hashlib.blake2b(
+            user_id.encode("utf-8"), digest_size=8
+        ).hexdigest()
+
         # ★ここで過去のプロフィールがあればセッションにセット（自動入力）★
         if prev_profile:
             st.toast("過去のプロフィール情報を復元しました", icon="✅")
@@ -632,28 +756,25 @@ def main():
             st.session_state["info_grade_text"] = prev_profile.get("info_course_grade")
 
     st.subheader("パーソナリティ質問")
-    kyushu_options = ["-- 選択してください --", "はい", "いいえ"]
 
     # keyを指定しているので、session_stateに値が入っていればそれが初期値になる
     kyushu_student = st.selectbox(
-        "九州大学の学生ですか？", kyushu_options, key="kyushu_student"
+        "九州大学の学生ですか？", KYUSHU_OPTIONS, key="kyushu_student"
     )
 
-    info_course_options = ["-- 選択してください --", "はい", "いいえ"]
     info_course_taken = st.selectbox(
         "情報科学の講義を受講したことがありますか？",
-        info_course_options,
+        INFO_COURSE_OPTIONS,
         key="info_course_taken",
     )
 
-    grade_options = ["未回答", "A", "B", "C", "D", "F"]
     info_course_grade = st.selectbox(
-        "受講していたときの成績（任意）", options=grade_options, key="info_grade_text"
+        "受講していたときの成績（任意）", options=GRADE_OPTIONS, key="info_grade_text"
     )
 
     if (
-        kyushu_student == kyushu_options[0]
-        or info_course_taken == info_course_options[0]
+        kyushu_student == KYUSHU_OPTIONS[0]
+        or info_course_taken == INFO_COURSE_OPTIONS[0]
     ):
         st.warning("必須のアンケート項目に回答してください。")
         st.stop()
@@ -665,53 +786,72 @@ def main():
     }
     st.session_state.survey_answers = survey_answers
 
-    df_items = load_items(user_id=user_id)
-    if df_items.empty:
+    # 出題リストはユーザーごとに一度だけ取得してセッションに保持する
+    if st.session_state.get("items_records") is None:
+        st.session_state.items_records = load_items(user_id=user_id)
+    items_records = st.session_state.items_records
+    if not items_records:
         st.error("正しくロードできる評価対象がありません。")
         st.stop()
 
-    all_indices = list(df_items["item_index"])
-    if st.session_state.get("current_index") is None:
-        st.session_state.current_index = get_next_index(all_indices, answered)
+    # 未回答の item_index はユーザーごとに一度だけ列挙し、以降は送信ごとにカーソルを進める
+    if st.session_state.get("pending_indices") is None:
+        st.session_state.pending_indices = [
+            idx
+            for idx, rec in enumerate(items_records)
+            if rec["source_userid"] not in answered
+        ]
+        st.session_state.pending_pos = 0
+    pending = st.session_state.pending_indices
+    cursor = st.session_state.pending_pos
 
-    current_index = st.session_state.current_index
+    current_index = pending[cursor] if cursor < len(pending) else None
     if current_index is None:
         st.success(
-            f"この参加者IDでは全 {len(df_items)} 件の比較が完了しています。ご協力ありがとうございました。"
+            f"この参加者IDでは全 {len(items_records)} 件の比較が完了しています。ご協力ありがとうございました。"
         )
         st.stop()
 
-    row = df_items.loc[df_items["item_index"] == current_index].iloc[0]
+    # item_index は 0..len-1 の連番なので、行はリストの位置で直接引ける
+    row = items_records[current_index]
     st.markdown("---")
-    st.subheader(f"サンプル {current_index + 1} / {len(df_items)}")
-    st.caption(f"{len(answered)} 件回答済み / 全 {len(df_items)} 件")
-
-    # 表示位置をユーザーID + item_index で決定（再現性あり）
-    seed = int.from_bytes(
-        hashlib.sha256(f"{user_id}_{current_index}".encode("utf-8")).digest()[:8], "big"
-    )
-    rng = random.Random(seed)
-    baseline_on_left = rng.choice([True, False])
-
-    # 左右の表示内容（A=baseline, B=student）
-    if baseline_on_left:
-        left_title = "フィードバックA"
-        left_content = row["baseline_response"]
-        right_title = "フィードバックB"
-        right_content = (
-            f"##### **{row['student_advice_title']}**\n\n{row['student_advice_body']}"
-        )
-        local_options = RATING_SCALE
-    else:
-        left_title = "フィードバックA"
-        left_content = (
-            f"**{row['student_advice_title']}**\n\n{row['student_advice_body']}"
+    st.subheader(f"サンプル {current_index + 1} / {len(items_records)}")
+    n_answered = sum(1 for rec in items_records if rec["source_userid"] in answered)
+    st.caption(f"{n_answered} 件回答済み / 全 {len(items_records)} 件")
+
+    # 表示位置と左右の表示内容はセッション内では (user_id, item_index) だけで決まるため、
+    # セッション内で一度だけ組み立てて使い回す
+    render_cache = st.session_state.setdefault("_render_cache", {})
+    layout_key = (user_id, current_index)
+    if layout_key not in render_cache:
+        # 表示位置をユーザーID + source_userid で決定（再現性あり）
+        # item_index は項目数や提示順が変わると別の項目を指すので、項目そのものの ID をシードにする
+        seed = int.from_bytes(
+            hashlib.sha256(
+                f"{user_id}_{row['source_userid']}".encode("utf-8")
+            ).digest()[:8],
+            "big",
         )
-        right_title = "フィードバックB"
-        right_content = row["baseline_response"]
-        local_options = RATING_SCALE[::-1]
+        baseline_on_left = random.Random(seed).choice([True, False])
+
+        # 左右の表示内容（A=baseline, B=student）
+        if baseline_on_left:
+            left_content = row["baseline_response"]
+            right_content = (
+                f"##### **{row['student_advice_title']}**\n\n"
+                f"{row['student_advice_body']}"
+            )
+        else:
+            left_content = (
+                f"**{row['student_advice_title']}**\n\n{row['student_advice_body']}"
+            )
+            right_content = row["baseline_response"]
+        render_cache[layout_key] = (baseline_on_left, left_content, right_content)
+    baseline_on_left, left_content, right_content = render_cache[layout_key]
+    left_title = "フィードバックA"
+    right_title = "フィードバックB"
 
-    content_col, flow_col = st.columns([3.5, 1.5])
+    content_col, flow_col = st.columns(LAYOUT_COL_WIDTHS)
 
     with content_col:
         st.markdown(f"#### 成績{row['baseline_grade']}の学生に対するフィードバック")
@@ -726,64 +866,41 @@ def main():
     with flow_col:
         st.markdown("#### 評価")
 
-        questions = [
-            ("readability", "ステップ1：可読性", "どちらが読みやすいと感じますか？"),
-            (
-                "persuasiveness",
-                "ステップ2：説得力",
-                "どちらの根拠が明確だと思いますか？",
-            ),
-            (
-                "actionability",
-                "ステップ3：行動可能性",
-                "成績向上のためのフィードバックが明確に示されていますか？",
-            ),
-            (
-                "hallucination",
-                "ステップ4：ハルシネーション",
-                "嘘や誇張と思われる表現を使っていますか？",
-            ),
-            (
-                "usefulness",
-                "ステップ5：有用性",
-                "あなたが学生だった場合、どちらのフィードバックが役に立つと思いますか？",
-            ),
-        ]
-
-        participant_key = str(abs(hash(user_id)))
+        participant_key = st.session_state.participant_key
         responses: Dict[str, str] = {}
+        # 各設問のユニークキーは描画と送信の両方で使うので、ここで一度だけ生成する
+        field_keys = {
+            field: f"{field}_{current_index}_{participant_key}"
+            for field, _, _ in QUESTIONS
+        }
 
         # コンテナとフォームの開始
         with st.container(height=800):
             with st.form(key=f"eval_form_{current_index}_{participant_key}"):
 
-                for field, title, description in questions:
+                for field, title, description in QUESTIONS:
                     st.markdown(f"**{title}**")
                     st.caption(description)
 
-                    # ユニークキーの生成
-                    key = f"{field}_{current_index}_{participant_key}"
+                    key = field_keys[field]
 
-                    # session_state の初期化
-                    if key not in st.session_state:
-                        st.session_state[key] = local_options[2]
-
-                    # カラム配置
-                    cols = st.columns([1.5, 0.8, 0.8, 0.8, 0.8, 0.8, 1.5])
+                    # カラム配置（両端のラベルだけなので中央は1カラムにまとめる）
+                    cols = st.columns(RATING_COL_WIDTHS)
                     cols[0].markdown("**Aが良い**", unsafe_allow_html=True)
 
                     # スライダー表示（ここで値は取得せず、表示のみ行う）
                     # keyを指定しているので、ユーザーの操作はsession_stateに自動記録されます
+                    # （初期値は中央。操作済みなら session_state の値が優先される）
                     st.select_slider(
                         "評価スコア",
-                        options=local_options,
-                        value=st.session_state.get(key, local_options[2]),
-                        key=f"slider_{key}",
+                        options=RATING_POSITIONS,
+                        value=RATING_CENTER,
+                        key=key,
                         label_visibility="collapsed",
                         format_func=lambda _: "",
                     )
 
-                    cols[6].markdown("**Bが良い**", unsafe_allow_html=True)
+                    cols[-1].markdown("**Bが良い**", unsafe_allow_html=True)
                     st.divider()
 
                 # コメント欄
@@ -804,17 +921,10 @@ def main():
 
                 if submitted:
                     # ===== ここで一括して値を回収します =====
-                    for field, _, _ in questions:
-                        key = f"{field}_{current_index}_{participant_key}"
-                        # フォーム送信時の最新の値を取得
-                        val = st.session_state.get(f"slider_{key}")
-
-                        if baseline_on_left:
-                            responses[field] = val
-                        else:
-                            # 逆転している場合の正規化
-                            idx = local_options.index(val)
-                            responses[field] = RATING_SCALE[idx]
+                    for field, key in field_keys.items():
+                        # フォーム送信時の最新の位置を取得し、ラベルに変換する
+                        pos = st.session_state.get(key, RATING_CENTER)
+                        responses[field] = RATING_SCALE[pos]
 
                     record = {
                         "timestamp": datetime.now().isoformat(),
@@ -826,12 +936,21 @@ def main():
                         **responses,
                         "comment": comment,
                     }
-                    save_response(record)
-
-                    # 次のインデックスへ
-                    st.session_state.current_index = get_next_index(
-                        all_indices, answered | {current_index}
-                    )
+                    try:
+                        save_response(record)
+                    except Exception as e:
+                        # 保存できていないので次へ進めない（入力はそのまま残るので再送信できる）
+                        st.error(
+                            f"評価の保存に失敗しました。もう一度「評価を保存して次へ」を押してください。({e})"
+                        )
+                        st.stop()
+
+                    # 回答済みになったサンプルの表示キャッシュはもう使わないので捨てる
+                    # （評価・コメント欄のキーは描画されなくなった時点で Streamlit が破棄する）
+                    render_cache.pop(layout_key, None)
+
+                    # 次の未回答インデックスへ
+                    st.session_state.pending_pos = cursor + 1
                     st.success("評価を保存しました！次のサンプルに進みます。")
                     st.rerun()
 
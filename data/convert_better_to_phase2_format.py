@@ -11,11 +11,17 @@ Usage:
 
 import argparse
 import json
-import re
 import sys
 from pathlib import Path
 from typing import Dict, Tuple
 
+try:
+    import orjson  # optional: faster JSON read/write, falls back to the stdlib json
+except ModuleNotFoundError:
+    orjson = None
+
+_DECODER = json.JSONDecoder()
+
 
 def parse_entry(user_id: str, raw: Dict, step: int) -> Dict:
     """Parse one user entry from better.json into the phase2 format."""
@@ -28,11 +34,12 @@ def parse_entry(user_id: str, raw: Dict, step: int) -> Dict:
         raise ValueError("missing grade or advice text")
 
     # Advice text is stored as 'assistant\\n\\n{...json...}'.
-    match = re.search(r"({.*)", raw_text, flags=re.S)
-    if not match:
+    # Decode straight from the first brace instead of slicing it out with a regex.
+    start = raw_text.find("{")
+    if start < 0:
         raise ValueError("could not locate inner JSON block")
 
-    inner = json.loads(match.group(1))
+    inner, _ = _DECODER.raw_decode(raw_text, start)
     advice = inner.get(user_id)
     if not isinstance(advice, dict):
         raise ValueError("inner advice missing or not a dict")
@@ -48,7 +55,10 @@ def parse_entry(user_id: str, raw: Dict, step: int) -> Dict:
 
 
 def convert(input_path: Path, output_path: Path, step: int) -> Tuple[int, int]:
-    data = json.loads(input_path.read_text())
+    if orjson is not None:
+        data = orjson.loads(input_path.read_bytes())
+    else:
+        data = json.loads(input_path.read_text())
 
     converted = {}
     errors = []
@@ -59,7 +69,13 @@ def convert(input_path: Path, output_path: Path, step: int) -> Tuple[int, int]:
         except Exception as exc:  # noqa: BLE001
             errors.append(f"{user_id}: {exc}")
 
-    output_path.write_text(json.dumps(converted, ensure_ascii=False, indent=2))
+    if orjson is not None:
+        # orjson writes UTF-8 bytes directly (non-ASCII kept as-is, 2-space indent).
+        output_path.write_bytes(orjson.dumps(converted, option=orjson.OPT_INDENT_2))
+    else:
+        # Serialize straight into the file so the whole document is never held as one string.
+        with output_path.open("w", encoding="utf-8") as f:
+            json.dump(converted, f, ensure_ascii=False, indent=2)
 
     for err in errors:
         print(f"[warn] {err}", file=sys.stderr)